@@ -12,6 +12,7 @@ instantaneous velocites, a looping grayscale video, and a looping color video
 with the center of mass overlaid. 
 """
 
+import os
 import numpy as np
 import tifffile as tiff
 from scipy import ndimage
@@ -19,6 +20,24 @@ import pickle
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 from conflux import extractmetadata  #  3rd party module
+try:
+    from numba import njit, prange  #  Optional, speeds up large stacks
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+try:
+    import cv2  #  Optional, used to save videos
+    CV2_AVAILABLE = True
+except ImportError:
+    CV2_AVAILABLE = False
+
+#  Number of pixels in a stack above which the compiled kernel is used
+LARGE_STACK_SIZE = 2**27
+#  Number of pixels in a stack above which frames are read one at a time
+STREAM_STACK_SIZE = 2**30
+
+#  Coordinate ranges already built for the center of mass, keyed by length
+arange_cache = {}
 
 def main():
     #  Print welcome message
@@ -46,13 +65,14 @@ def main():
                  including the file extension.
                    """
     
-    #  Load data as an array
+    #  Load data and calculate center of mass for each frame
     file_present = False
     #  Counter to display help message
     attempts = 0
     while file_present == False:  
         try:
-            array_tiff = tiff.imread(tiff_filename)
+            cmx_coords, cmy_coords = calculate_center_of_mass_from_file(
+                tiff_filename)
             timestamps = extract_timestamps(metadata_filename)
             file_present = True
         except IOError:
@@ -66,42 +86,28 @@ def main():
           Type the letter followed by ENTER:
           g -- grayscale video
           c -- color video with center of mass overlay
+          r -- RGB preview video without center of mass overlay
+          v -- save color video with center of mass overlay as mp4
           p -- x- and y- histograms of instanteous velocities
           o -- view this options menu
           q -- quit
           """
     print(options_message)
     
-    #  Calculate center of mass for each frame
-    cmx_coords = []
-    cmy_coords = []
-    for frame in range(len(array_tiff)):
-        cmx, cmy = calculate_center_of_mass(array_tiff[frame])
-        cmx_coords.append(cmx)
-        cmy_coords.append(cmy)
-    #test_cm_calc(array_tiff)  #  Test accuracy of cm calculation
+    #test_cm_calc(load_tiff_stack(tiff_filename))  #  Test cm accuracy
         
-    #  Convert coordinates to floats
-    cmx_coords_floats = [float(coord) for coord in cmx_coords]
-    cmy_coords_floats = [float(coord) for coord in cmy_coords]
-    
-    #  Calculate displacement of cm coordinates
-    x_disp,y_disp = calculate_displacement(cmx_coords_floats,cmy_coords_floats)
-    
-    #  Calculate time steps
-    time_steps = calculate_time_steps(timestamps)
-    
     #  Calculate instantaneous velocity for x- and y-coordinates
-    x_inst_vel, y_inst_vel = calculate_inst_vel(x_disp, y_disp, time_steps)
+    x_inst_vel, y_inst_vel = calculate_xy_inst_vel(cmx_coords, cmy_coords,
+                                                   timestamps)
     
-    #  Round cmx and cmy coordinate lists
-    cmx_rounded = [round(coord) for coord in cmx_coords_floats]
-    cmy_rounded = [round(coord) for coord in cmy_coords_floats]
+    #  Round cmx and cmy coordinates to pixel indices
+    cmx_rounded = np.rint(cmx_coords).astype(np.intp)
+    cmy_rounded = np.rint(cmy_coords).astype(np.intp)
     
     #  Get user options
     user_choice = get_options()
-    display_data(user_choice, array_tiff, x_inst_vel, y_inst_vel, cmx_rounded,
-                 cmy_rounded, options_message)
+    display_data(user_choice, tiff_filename, x_inst_vel, y_inst_vel,
+                 cmx_rounded, cmy_rounded, options_message)
 
 #------------------------------------------------------------------------------
 #  USER INTERFACE
@@ -111,7 +117,7 @@ def get_options():
     Displays program options, gets user choice and validates the input.
     """
     
-    valid_inputs = ["g","c","p","o","h","q"]
+    valid_inputs = ["g","c","r","v","p","o","h","q"]
     user_input = input("Choice: ").lower()
     
     if user_input not in valid_inputs:
@@ -123,22 +129,28 @@ def get_options():
                 
     return user_input
 
-def display_data(user_choice, array_tiff, x_inst_vel, y_inst_vel,
+def display_data(user_choice, tiff_filename, x_inst_vel, y_inst_vel,
                  cmx_rounded, cmy_rounded, options_message):
     """
     Displays data based on user input.
     
     Keyword arguments:
     user_choice -- user choice for options menu
-    array_tiff -- multidimensional array of tiff images
-    x_inst_vel -- list of instantaneous velocities for x-coordinates
-    y_inst_vel -- list of instantaneous velocities for y-coordinates
-    cmx_rounded -- list of rounded x coordinates for center of mass of 3D array
-    cmy_rounded -- list of rounded y coordinates for center of mass of 3D array
+    tiff_filename -- filename of tiff image stack, loaded only for videos
+    x_inst_vel -- array of instantaneous velocities for x-coordinates
+    y_inst_vel -- array of instantaneous velocities for y-coordinates
+    cmx_rounded -- rounded x coordinates for center of mass of 3D array
+    cmy_rounded -- rounded y coordinates for center of mass of 3D array
     """
     
+    array_tiff = None
     quit_program = False
     while quit_program == False:
+        needs_stack = (user_choice in ['g', 'c', 'r'] or
+                       (user_choice == 'v' and CV2_AVAILABLE))
+        if needs_stack and array_tiff is None:
+            array_tiff = load_tiff_stack(tiff_filename)
+        
         if user_choice == 'g':
             play_image_stack(array_tiff)
             user_choice = get_options()
@@ -148,6 +160,18 @@ def display_data(user_choice, array_tiff, x_inst_vel, y_inst_vel,
             play_image_stack(stack_overlaid)
             print(options_message)
             user_choice = get_options()
+        elif user_choice == 'r':
+            play_image_stack(display_rgb_preview(array_tiff))
+            print(options_message)
+            user_choice = get_options()
+        elif user_choice == 'v':
+            if CV2_AVAILABLE:
+                save_cm_video(array_tiff, cmx_rounded, cmy_rounded,
+                              'cm_overlay.mp4')
+            else:
+                print("Saving videos requires OpenCV (opencv-python).")
+            print(options_message)
+            user_choice = get_options()
         elif user_choice == 'p':
             plot_xy_inst_vel(x_inst_vel, y_inst_vel)
             user_choice = get_options()
@@ -171,11 +195,46 @@ def test_cm_calc(array_tiff):
     img_grayscale = array_tiff[:,:,0]  #  Converts color (3 dimensional) array
                                        #  to grayscale (2 dimensional) array.
     scipy_cm = ndimage.measurements.center_of_mass(img_grayscale)
-    hwritten_cm = calculate_center_of_mass(img_grayscale)
+    hwritten_cm = calculate_center_of_mass(img_grayscale[np.newaxis])
     
     print("Scipy calculation: ", scipy_cm)
     print("Personal calculation: ", hwritten_cm)
 
+def load_tiff_stack(tiff_filename):
+    """
+    Load tiff image stack as a read-only memory-mapped array so frames are
+    read from disk as needed rather than all at once. Stacks that cannot be
+    memory-mapped (e.g. compressed files) are read into memory instead.
+
+    Keyword arguments:
+    tiff_filename -- filename of tiff image stack
+    """
+    
+    try:
+        array_tiff = tiff.memmap(tiff_filename, mode='r')
+    except ValueError:
+        array_tiff = tiff.imread(tiff_filename)
+    
+    return array_tiff
+
+def calculate_center_of_mass_from_file(tiff_filename):
+    """
+    Calculate center of mass for each frame of a tiff image stack file.
+    Stacks larger than STREAM_STACK_SIZE pixels are read one frame at a
+    time, otherwise the whole (memory-mapped) stack is reduced at once.
+
+    Keyword arguments:
+    tiff_filename -- filename of tiff image stack
+    """
+    
+    with tiff.TiffFile(tiff_filename) as tif:
+        num_frames = len(tif.pages)
+        height, width = tif.pages[0].shape
+        if num_frames * height * width > STREAM_STACK_SIZE:
+            return stream_center_of_mass(tif.pages)
+    
+    return calculate_center_of_mass(load_tiff_stack(tiff_filename))
+
 def extract_timestamps(metadata):
     """
     Extract timestamps from metadata file. Function ("extractmetadata") used
@@ -185,12 +244,28 @@ def extract_timestamps(metadata):
     metadata -- filename of metadata (*.txt) file from an Andor camera
     """
     
-    #  Extract metadata in pickle format
-    extractmetadata(metadata, log = False)
+    pickle_filename = 'channel-0_time-series.pickle'
+    source_filename = 'channel-0_time-series.source.pickle'
+    
+    #  Identify the metadata file by its full path and modification time
+    metadata_source = (os.path.abspath(metadata), os.path.getmtime(metadata))
+    
+    #  Look up which metadata file the existing pickle was extracted from
+    cached_source = None
+    if os.path.exists(pickle_filename) and os.path.exists(source_filename):
+        with open(source_filename, 'rb') as source_file:
+            cached_source = pickle.load(source_file)
+    
+    #  Extract metadata in pickle format, unless already extracted from this
+    #  same, unmodified metadata file
+    if cached_source != metadata_source:
+        extractmetadata(metadata, log = False)
+        with open(source_filename, 'wb') as source_file:
+            pickle.dump(metadata_source, source_file)
     
     #  Open and unpickle file
-    pickle_file = open('channel-0_time-series.pickle', 'rb')
-    timestamps = pickle.load(pickle_file)
+    with open(pickle_filename, 'rb') as pickle_file:
+        timestamps = np.asarray(pickle.load(pickle_file), dtype=np.float64)
     
     return timestamps
 
@@ -199,95 +274,200 @@ def extract_timestamps(metadata):
 
 def calculate_center_of_mass(array_tiff):
     """
-    Calculate center of mass for each slice of a 3D array.
+    Calculate center of mass for each slice of a 3D array. Returns arrays of
+    x and y coordinates with one entry per frame.
     
     Keyword arguments:
-    array_tiff -- multidimensional array of tiff images
+    array_tiff -- multidimensional array of tiff images (frame, row, column)
     """
     
-    #  Sum x(column) and y(row) intensity values
-    m_x = array_tiff.sum(axis=1)
-    m_y = array_tiff.sum(axis=0)
+    #  Walk very large stacks once with the compiled kernel if available
+    if NUMBA_AVAILABLE and array_tiff.size > LARGE_STACK_SIZE:
+        return com_stack(np.ascontiguousarray(array_tiff))
+    
+    #  Arbitrary distance from the origin along x(row) and y(column) axes
+    num_frames, height, width = array_tiff.shape
+    x_range = cached_arange(height)
+    y_range = cached_arange(width)
+    
+    #  Sum x(row) and y(column) intensity values for every frame. The pass
+    #  over the stack accumulates in single precision so integer (e.g.
+    #  uint16) stacks cannot overflow, while the much smaller sums are
+    #  promoted to double precision, since unrounded coordinates feed the
+    #  velocity calculation where sub-pixel steps matter.
+    m_x = array_tiff.sum(axis=2, dtype=np.float32).astype(np.float64)
+    m_y = array_tiff.sum(axis=1, dtype=np.float32).astype(np.float64)
+    
+    #  cm = sum(m*r)/sum(m), weighted sums taken over the whole stack at once.
+    #  optimize=True lets einsum hand the contraction to BLAS (gemv). The
+    #  float marginals are contracted rather than the raw stack, since an
+    #  optimized 'fhw,h->f' sums the unweighted axis in the stack's own
+    #  integer dtype first and overflows.
+    num_x = np.einsum('fh,h->f', m_x, x_range, optimize=True)
+    num_y = np.einsum('fw,w->f', m_y, y_range, optimize=True)
+    denom = m_x.sum(axis=1)
+    
+    return(num_x / denom, num_y / denom)
+
+def stream_center_of_mass(pages):
+    """
+    Calculate center of mass for each page of a tiff file, decoding one
+    frame at a time into a reused buffer so only a single frame is held in
+    memory.
     
-    #  cm = sum(m*r)/sum(m), where r is the arbitrary distance from the origin
-    cmx = (np.sum(m_x * (np.arange(m_x.size))) / np.sum(m_x))
-    cmy = (np.sum(m_y * (np.arange(m_y.size))) / np.sum(m_y))
+    Keyword arguments:
+    pages -- pages of an open tifffile.TiffFile, one grayscale frame each
+    """
     
-    return(cmx, cmy)
+    num_frames = len(pages)
+    height, width = pages[0].shape
+    x_range = cached_arange(height)
+    y_range = cached_arange(width)
+    frame_buffer = np.empty((height, width), dtype=pages[0].dtype)
+    
+    cmx = np.empty(num_frames)
+    cmy = np.empty(num_frames)
+    for frame, page in enumerate(pages):
+        image = page.asarray(out=frame_buffer)
+        m_x = image.sum(axis=1, dtype=np.float64)
+        m_y = image.sum(axis=0, dtype=np.float64)
+        m = m_x.sum()
+        cmx[frame] = (x_range @ m_x) / m
+        cmy[frame] = (m_y @ y_range) / m
+    
+    return cmx, cmy
 
-def calculate_displacement(cmx,cmy):
+def cached_arange(size):
     """
-    Calculate displacement (aka. step values) of (x,y) coordinates.
-
+    Return a read-only float64 range of the given length, building it only
+    the first time each length is requested.
+    
     Keyword arguments:
-    cmx -- list of floating x coordinates for center of mass of 3D array
-    cmy -- list of floating y coordinates for center of mass of 3D array
+    size -- number of elements in the range
     """
     
-    x_disp = []
-    y_disp = []
+    coord_range = arange_cache.get(size)
+    if coord_range is None:
+        coord_range = np.arange(size, dtype=np.float64)
+        coord_range.flags.writeable = False
+        arange_cache[size] = coord_range
     
-    #  Create lists to multiply through
-    x_init = cmx[:]
-    x_final = cmx[1:]
-    y_init = cmy[:]
-    y_final = cmy[1:]
+    return coord_range
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def com_stack(array_tiff):
+        """
+        Calculate center of mass for each slice of a 3D array in a single
+        pass, accumulating the total and weighted intensities per frame.
+        
+        Keyword arguments:
+        array_tiff -- C-contiguous array of tiff images (frame, row, column)
+        """
+        
+        num_frames, height, width = array_tiff.shape
+        cmx = np.empty(num_frames)
+        cmy = np.empty(num_frames)
+        
+        for frame in prange(num_frames):
+            m = 0.0
+            m_x = 0.0
+            m_y = 0.0
+            for row in range(height):
+                for column in range(width):
+                    value = array_tiff[frame, row, column]
+                    m += value
+                    m_x += value * row
+                    m_y += value * column
+            cmx[frame] = m_x / m
+            cmy[frame] = m_y / m
+        
+        return cmx, cmy
     
-    #  Calculate displacement
-    for (x_init_value, x_final_value) in zip(x_init, x_final):
-        disp_x_value = x_final_value - x_init_value
-        x_disp.append(disp_x_value)
+    @njit(fastmath=True, cache=True)
+    def disp_vel(cm_coords, timestamps):
+        """
+        Calculate instantaneous velocities of a single coordinate in one
+        pass, without storing the displacements or time steps.
+        
+        Keyword arguments:
+        cm_coords -- array of center of mass coordinates for each frame
+        timestamps -- array of timestamps for tiff stack
+        """
+        
+        num_steps = max(min(cm_coords.size, timestamps.size) - 1, 0)
+        inst_vel = np.empty(num_steps)
         
-    for (y_init_value, y_final_value) in zip(y_init, y_final):
-        disp_y_value = y_final_value - y_init_value
-        y_disp.append(disp_y_value)
+        for step in range(num_steps):
+            inst_vel[step] = ((cm_coords[step + 1] - cm_coords[step]) /
+                              (timestamps[step + 1] - timestamps[step]))
         
-    return x_disp, y_disp
+        return inst_vel
 
-def calculate_time_steps(timestamps):
+def calculate_xy_inst_vel(cmx, cmy, timestamps):
     """
-    Calculate time steps for individual frames of a tiff stack.
+    Calculate instantaneous velocities of (x,y) coordinates from the center
+    of mass coordinates and frame timestamps, using the compiled kernel if
+    available.
 
     Keyword arguments:
-    timestamps -- list of timestamps for tiff stack
+    cmx -- array of floating x coordinates for center of mass of 3D array
+    cmy -- array of floating y coordinates for center of mass of 3D array
+    timestamps -- array of timestamps for tiff stack
     """
     
-    time_steps = []
+    #  Only use frames present in both, in case the stack and metadata
+    #  disagree on the number of frames
+    num_frames = min(len(cmx), len(cmy), len(timestamps))
+    cmx = cmx[:num_frames]
+    cmy = cmy[:num_frames]
+    timestamps = np.asarray(timestamps)[:num_frames]
     
-    #  Create lists to multiply through
-    time_init = timestamps[:]
-    time_final = timestamps[1:]
+    if NUMBA_AVAILABLE:
+        return disp_vel(cmx, timestamps), disp_vel(cmy, timestamps)
     
-    #  Calculate time steps
-    for (time_init_value, time_final_value) in zip(time_init, time_final):
-        frame_time_value = time_final_value - time_init_value
-        time_steps.append(frame_time_value)
-        
-    return time_steps
+    x_disp, y_disp = calculate_displacement(cmx, cmy)
+    time_steps = calculate_time_steps(timestamps)
+    
+    return calculate_inst_vel(x_disp, y_disp, time_steps)
+
+def calculate_displacement(cmx, cmy):
+    """
+    Calculate displacement (aka. step values) of (x,y) coordinates.
+
+    Keyword arguments:
+    cmx -- array of floating x coordinates for center of mass of 3D array
+    cmy -- array of floating y coordinates for center of mass of 3D array
+    """
+    
+    return np.diff(cmx), np.diff(cmy)
+
+def calculate_time_steps(timestamps):
+    """
+    Calculate time steps for individual frames of a tiff stack.
+
+    Keyword arguments:
+    timestamps -- array of timestamps for tiff stack
+    """
+    
+    return np.diff(np.asarray(timestamps))
 
 def calculate_inst_vel(x_disp, y_disp, time_steps):
     """
     Calculate instantaneous velocities of (x,y) coordinates.
 
     Keyword arguments:
-    x_disp -- list of step values of x-coordinates
-    y_disp -- list of step values of y-coordinates
-    time_steps -- list of time step values for frames of a tiff stack
+    x_disp -- array of step values of x-coordinates
+    y_disp -- array of step values of y-coordinates
+    time_steps -- array of time step values for frames of a tiff stack
     """
     
-    x_inst_vel = []
-    y_inst_vel = []
+    #  Only use steps present in both, in case the stack and metadata
+    #  disagree on the number of frames
+    num_steps = min(len(x_disp), len(y_disp), len(time_steps))
+    time_steps = time_steps[:num_steps]
     
-    #  Calculate instantaneous velocities
-    for (x_disp_value, time_step) in zip(x_disp, time_steps):
-        x_inst_vel_value = x_disp_value/time_step
-        x_inst_vel.append(x_inst_vel_value)
-        
-    for (y_disp_value, time_step) in zip(y_disp, time_steps):
-        y_inst_vel_value = y_disp_value/time_step
-        y_inst_vel.append(y_inst_vel_value)
-        
-    return x_inst_vel, y_inst_vel
+    return x_disp[:num_steps] / time_steps, y_disp[:num_steps] / time_steps
 
 #------------------------------------------------------------------------------
 #  DATA VISUALIZATION
@@ -296,8 +476,8 @@ def plot_xy_inst_vel(x_inst_vel, y_inst_vel):
     """
     Plot x and y instantaneous velocities as separate histograms.
 
-    x_inst_vel -- list of instantaneous velocities for x-coordinates
-    y_inst_vel -- list of instantaneous velocities for y-coordinates
+    x_inst_vel -- array of instantaneous velocities for x-coordinates
+    y_inst_vel -- array of instantaneous velocities for y-coordinates
     """
 
     plt.figure(1)
@@ -317,16 +497,21 @@ def play_image_stack(array_tiff):
     array_tiff -- multidimensional array of tiff images
     """
     
-    fig = plt.figure()
-    images = []
+    fig, ax = plt.subplots()
+    image = ax.imshow(array_tiff[0], animated = True)
     
-    #  Loop through each slice of 3D array, animate and store in list
-    for frame in range(len(array_tiff)):
-        image = plt.imshow(array_tiff[frame], animated = True)
-        images.append([image])
+    def update_frame(frame):
+        """
+        Replace the displayed image with the given slice of the 3D array.
+        """
         
-    #  Initialize animation
-    ani = animation.ArtistAnimation(fig, images, interval=50)
+        image.set_data(array_tiff[frame])
+        image.autoscale()  #  Rescale intensities for each frame
+        return (image,)
+        
+    #  Initialize animation, reusing a single image for every frame
+    ani = animation.FuncAnimation(fig, update_frame, frames=len(array_tiff),
+                                  interval=50, blit=True)
     plt.show()
 
 def display_cm_overlay(array_tiff, cmx_rounded, cmy_rounded):
@@ -335,33 +520,110 @@ def display_cm_overlay(array_tiff, cmx_rounded, cmy_rounded):
 
     Keyword arguments:
     array_tiff -- multidimensional array of tiff images
-    cmx_rounded -- list of rounded x coordinates for center of mass of 3D array
-    cmy_rounded -- list of rounded y coordinates for center of mass of 3D array
+    cmx_rounded -- rounded x coordinates for center of mass of 3D array
+    cmy_rounded -- rounded y coordinates for center of mass of 3D array
     """
     
-    list_rgb = []
-    coord_count = 0
+    #  Convert grayscale images to RGB by copying the intensity values into
+    #  all three channels of a single preallocated stack
+    num_frames, height, width = array_tiff.shape
+    cm_overlay = np.empty((num_frames, height, width, 3),
+                          dtype=array_tiff.dtype)
+    cm_overlay[...] = array_tiff[..., np.newaxis]
     
-    #  Iterate through frames and convert grayscale images to RGB images.
-    for image in range(len(array_tiff)):
-        #  Create index values for center of mass
-        x_index = (cmx_rounded[coord_count])
-        y_index = (cmy_rounded[coord_count])
-        coord_count += 1
-        
-        #  Convert each frame to RGB
-        rbg_channel = array_tiff[image]
-        image_rgb = np.stack((rbg_channel, rbg_channel, rbg_channel), axis=2)
-        
-        #  Add red pixel at center of mass cordinates
-        #  To change color of cm pixel, change RGB intensity values below
-        image_rgb[x_index, y_index, :] = [255, 0, 0]
-        list_rgb.append(image_rgb)
-        
-    cm_overlay = np.asarray(list_rgb)
+    #  Add red pixel at center of mass cordinates of every frame
+    #  To change color of cm pixel, change RGB intensity values below
+    frames = np.arange(num_frames)
+    cm_overlay[frames, cmx_rounded, cmy_rounded, :] = [255, 0, 0]
     
     return cm_overlay
 
+def scale_to_uint8(image):
+    """
+    Stretch a grayscale image to the full 8-bit range, like the per-frame
+    autoscaling of the grayscale video. 8-bit images are returned as is.
+
+    Keyword arguments:
+    image -- single grayscale tiff image
+    """
+    
+    if image.dtype == np.uint8:
+        return image
+    
+    #  Work in floating point so signed (e.g. background-subtracted int16)
+    #  images cannot overflow when the minimum is subtracted
+    low = float(image.min())
+    high = float(image.max())
+    scale = 255.0 / (high - low) if high > low else 0.0
+    scaled = np.subtract(image, low, dtype=np.float64) * scale
+    
+    return np.clip(np.rint(scaled), 0, 255).astype(np.uint8)
+
+def display_rgb_preview(array_tiff):
+    """
+    Convert grayscale tiff image stack to RGB with as little copying as
+    possible.
+
+    The three channels are a read-only broadcast view of a grayscale stack,
+    so no RGB stack is allocated. Matplotlib clips integer RGB images to
+    0-255, so stacks that are not already 8-bit (including signed,
+    background-subtracted stacks) are first rescaled frame by frame from
+    their minimum and maximum to 8-bit intensities with scale_to_uint8.
+    This costs one 8-bit copy of each frame, still a third of the RGB
+    stack. The view cannot be written to, so it has no center of mass
+    pixel; use display_cm_overlay when the overlay is needed.
+
+    Keyword arguments:
+    array_tiff -- multidimensional array of tiff images
+    """
+    
+    if array_tiff.dtype != np.uint8:
+        array_gray = np.empty(array_tiff.shape, dtype=np.uint8)
+        
+        for frame in range(len(array_tiff)):
+            array_gray[frame] = scale_to_uint8(array_tiff[frame])
+        array_tiff = array_gray
+    
+    rgb_shape = array_tiff.shape + (3,)
+    
+    return np.broadcast_to(array_tiff[..., np.newaxis], rgb_shape)
+
+def save_cm_video(array_tiff, cmx_rounded, cmy_rounded, video_filename,
+                  fps=20):
+    """
+    Save grayscale tiff image stack with the center of mass overlaid as an
+    mp4 video with OpenCV, bypassing the matplotlib window. Each frame is
+    converted to 8-bit BGR and written on its own, so the RGB stack is never
+    built. Returns whether the video was written.
+
+    Keyword arguments:
+    array_tiff -- multidimensional array of tiff images
+    cmx_rounded -- rounded x coordinates for center of mass of 3D array
+    cmy_rounded -- rounded y coordinates for center of mass of 3D array
+    video_filename -- filename of the mp4 video to write
+    fps -- frames per second of the video (default 20, matching playback)
+    """
+    
+    num_frames, height, width = array_tiff.shape
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    video_writer = cv2.VideoWriter(video_filename, fourcc, fps,
+                                   (width, height))
+    if not video_writer.isOpened():
+        print("Could not open", video_filename, "for writing.")
+        return False
+    
+    #  OpenCV expects 8-bit frames in BGR channel order, so the red center
+    #  of mass pixel is (0, 0, 255)
+    image_bgr = np.empty((height, width, 3), dtype=np.uint8)
+    for frame in range(num_frames):
+        image_bgr[...] = scale_to_uint8(array_tiff[frame])[..., np.newaxis]
+        image_bgr[cmx_rounded[frame], cmy_rounded[frame], :] = [0, 0, 255]
+        video_writer.write(image_bgr)
+    video_writer.release()
+    
+    print("Video saved as", video_filename)
+    return True
+
 #  Initialize program with error handling
 try:
     main()